@@ -1,44 +1,94 @@
+import atexit
+import collections
 import logging
+import logging.handlers
+import mimetypes
+import queue
+import stat
+import threading
 import time
 import os
-import base64
-import glob
+import hashlib
 from io import BytesIO
 from datetime import datetime
 from gtts import gTTS
+import orjson
 import pygame
 
 from mqtt_handler import SightCeptionMQTTHandler
-from yolo_api import YOLODetector
-from flask import Flask, jsonify, send_from_directory, request, render_template_string, url_for
+from yolo_api import YOLODetector, FrameBatcher
+from flask import Flask, Response, abort, send_file, request, url_for
+from flask_compress import Compress
+from waitress import serve
+from werkzeug.utils import safe_join
 
 # --- Configuration ---
 BROKER_HOST = "broker.hivemq.com"
 BROKER_PORT = 1883
 USERNAME = None  
 PASSWORD = None
+CAPTURE_TOPIC = "sightception/camera/command"
+TTS_CACHE_MAX = 64  # Max cached announcement clips kept on disk
+IMAGE_CACHE_MAX = 4  # Max served files kept in memory by /images
+
+# --- Paths ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGE_DIR = os.path.join(BASE_DIR, "received_images")
+CURRENT_IMAGE_PATH = os.path.join(IMAGE_DIR, "current_image.jpg")
+TTS_CACHE_DIR = os.path.join(IMAGE_DIR, "tts_cache")
 
 # Global variables for flow control
 current_device_id = None
 image_fetching_active = False
 
+# Pending (device_id, detected_objects) announcements, played in order
+audio_queue = queue.Queue()
 
-def empty_image_folder():
+# filename -> (etag, bytes) for recently served images, oldest first
+image_cache = collections.OrderedDict()
+image_cache_lock = threading.Lock()
+
+
+def json_response(payload):
     """
-    Empty the received_images folder to ensure no old images are retained.
+    Serialize a payload with orjson into a JSON response.
     """
-    image_folder = os.path.join(os.path.dirname(__file__), "received_images")
-    if os.path.exists(image_folder):
-        for file in glob.glob(os.path.join(image_folder, "*.jpg")):
-            try:
-                os.remove(file)
-            except:
-                pass
+    return Response(orjson.dumps(payload), mimetype='application/json')
 
 
-def on_image_received():
+def latest_image_info():
     """
-    Called when an image is received. Stop fetching and do object detection.
+    Stat the current image once and return (url, mtime), or (None, None) if absent.
+    The URL carries the mtime so clients only refetch when the frame changes.
+    """
+    try:
+        st = os.stat(CURRENT_IMAGE_PATH)
+    except FileNotFoundError:
+        return None, None
+    url = url_for('serve_image', filename='current_image.jpg', v=st.st_mtime_ns)
+    return url, st.st_mtime
+
+
+def empty_image_folder():
+    """
+    Empty the received_images folder to ensure no old images are retained.
+    """
+    try:
+        with os.scandir(IMAGE_DIR) as entries:
+            for entry in entries:
+                if entry.name.endswith('.jpg'):
+                    try:
+                        os.unlink(entry.path)
+                    except OSError:
+                        pass
+    except FileNotFoundError:
+        pass
+
+
+def on_image_received(image_data):
+    """
+    Called when an image is received. Stop fetching and do object detection
+    on the in-memory frame.
     """
     global image_fetching_active, current_device_id
     
@@ -49,79 +99,133 @@ def on_image_received():
     image_fetching_active = False
     mqtt_handler.stop_image_polling()
     
-    # Do object detection
-    current_image_path = os.path.join(os.path.dirname(__file__), "received_images", "current_image.jpg")
-    if os.path.exists(current_image_path):
-        logging.info(f"Processing image: {current_image_path}")
-        
-        # Process the image with YOLO
-        detected_objects = yolo_detector.predict(current_image_path)
-        logging.info(f"Detection complete. Found: {detected_objects}")
-        
-        # # Delete image after detection
-        # try:
-        #     os.remove(current_image_path)
-        #     logging.info("Image deleted after detection")
-        # except:
-        #     pass
-        
-        # Handle detection result
-        if detected_objects:
-            # Objects detected - generate audio and play
-            generate_and_play_audio(current_device_id, detected_objects)
-        else:
-            # No objects detected - continue fetching
-            logging.info("No objects detected, continuing to fetch images")
-            start_image_fetching()
+    # Do object detection (batched with any other pending frames)
+    logging.info("Processing image: %d bytes", len(image_data))
+    frame_batcher.submit(image_data, on_detection_complete)
+
+
+def on_detection_complete(detected_objects):
+    """
+    Called with the YOLO result for a fetched image.
+    """
+    logging.info("Detection complete. Found: %s", detected_objects)
+
+    # Handle detection result
+    if detected_objects:
+        # Objects detected - queue the announcement
+        audio_queue.put((current_device_id, detected_objects))
+    else:
+        # No objects detected - continue fetching
+        logging.info("No objects detected, continuing to fetch images")
+        start_image_fetching()
+
+
+def evict_tts_cache():
+    """
+    Keep only the TTS_CACHE_MAX most recently used clips in the TTS cache.
+    """
+    try:
+        clips = [e for e in os.scandir(TTS_CACHE_DIR) if e.name.endswith('.mp3')]
+    except FileNotFoundError:
+        return
+    if len(clips) <= TTS_CACHE_MAX:
+        return
+    clips.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    for entry in clips[TTS_CACHE_MAX:]:
+        try:
+            os.unlink(entry.path)
+        except OSError:
+            pass
+
+
+def get_tts_audio(detected_objects):
+    """
+    Return the path of an MP3 announcing the detected objects.
+    Clips are cached by object set so repeat detections skip the gTTS round-trip.
+    """
+    names = sorted(detected_objects)
+    key = hashlib.sha1(",".join(names).encode()).hexdigest()
+    audio_path = os.path.join(TTS_CACHE_DIR, f"{key}.mp3")
+
+    if os.path.exists(audio_path):
+        # Touch so eviction treats it as recently used
+        os.utime(audio_path)
+        logging.info("TTS cache hit: %s", audio_path)
+        return audio_path
+
+    text_to_speak = f"I detected {', and '.join(names)}."
+    logging.info("Generating TTS audio: '%s'", text_to_speak)
+
+    # Stream TTS audio straight to disk; rename only once complete so a
+    # failed request never leaves a truncated clip in the cache
+    os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{audio_path}.part"
+    try:
+        gTTS(text=text_to_speak, lang='en').save(tmp_path)
+        os.replace(tmp_path, audio_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    logging.info("Audio saved to: %s", audio_path)
+
+    evict_tts_cache()
+    return audio_path
 
 
 def generate_and_play_audio(device_id, detected_objects):
     """
-    Generate TTS audio, save it, and play it.
+    Generate (or reuse cached) TTS audio and play it.
     """
-    text_to_speak = f"I detected {', and '.join(detected_objects)}."
-    logging.info(f"Generating TTS audio: '{text_to_speak}'")
-    
     try:
-        # Generate TTS audio
-        tts = gTTS(text=text_to_speak, lang='en')
-        audio_buffer = BytesIO()
-        tts.write_to_fp(audio_buffer)
-        audio_buffer.seek(0)
+        audio_path = get_tts_audio(detected_objects)
         
-        # Save audio to file
-        audio_path = os.path.join(os.path.dirname(__file__), "received_images", "detection_audio.mp3")
-        with open(audio_path, 'wb') as f:
-            f.write(audio_buffer.getvalue())
-        logging.info(f"Audio saved to: {audio_path}")
-        
-        # Play the audio
+        # Play the audio (mixer is initialized once at startup)
         try:
-            pygame.mixer.init()
-            pygame.mixer.music.load(audio_path)
-            pygame.mixer.music.play()
+            sound = pygame.mixer.Sound(audio_path)
+            sound.play()
             logging.info("Playing detection audio...")
             
-            # Wait for audio to finish playing
-            while pygame.mixer.music.get_busy():
-                pygame.time.Clock().tick(10)
+            # Block for the clip length instead of polling get_busy()
+            pygame.time.wait(int(sound.get_length() * 1000) + 50)
             
-            pygame.mixer.quit()
             logging.info("Audio playback completed")
-            
-            # # Clean up audio file after playing
-            # try:
-            #     os.remove(audio_path)
-            #     logging.info("Audio file cleaned up")
-            # except Exception as e:
-            #     logging.warning(f"Failed to clean up audio file: {e}")
                 
         except Exception as e:
-            logging.error(f"Failed to play audio: {e}")
-            pygame.mixer.quit()
+            logging.error("Failed to play audio: %s", e)
             
     except Exception as e:
-        logging.error(f"Failed to generate audio: {e}")
+        logging.error("Failed to generate audio: %s", e)
+
+
+def audio_worker():
+    """
+    Play queued announcements one at a time off the request/MQTT threads.
+    """
+    while True:
+        device_id, detected_objects = audio_queue.get()
+        try:
+            generate_and_play_audio(device_id, detected_objects)
+        except Exception as e:
+            logging.error("Audio worker failed: %s", e)
+        finally:
+            audio_queue.task_done()
+
+
+def _capture_and_wait(timeout=6.0):
+    """
+    Ask the ESP32-CAM for a single frame and wait for it to land on disk.
+    Returns (sent, arrived).
+    """
+    # Subscribe to image stream while capturing
+    mqtt_handler.start_image_polling()
+
+    # Forget any earlier frame so only a fresh one wakes us up
+    mqtt_handler.image_arrived_event.clear()
+    sent = mqtt_handler.publish_json(CAPTURE_TOPIC, {"action": "capture_once", "ts": int(time.time())})
+    arrived = mqtt_handler.image_arrived_event.wait(timeout) if sent else False
+
+    mqtt_handler.stop_image_polling()
+    return sent, arrived
 
 
 def start_image_fetching():
@@ -146,8 +250,8 @@ def on_signal_received(device_id, signal_data):
     """
     global current_device_id
     
-    logging.info(f"Received wake word signal from device {device_id}")
-    logging.info(f"Signal data: {signal_data}")
+    logging.info("Received wake word signal from device %s", device_id)
+    logging.info("Signal data: %s", signal_data)
 
     # Set current device info
     current_device_id = device_id
@@ -161,10 +265,20 @@ def on_signal_received(device_id, signal_data):
 
 
 if __name__ == "__main__":
+    # Log records are queued by the calling thread and written to the console
+    # by a listener thread, so MQTT/request threads never block on stream I/O.
+    # force=True replaces the console handler installed by mqtt_handler on import.
+    log_queue = queue.SimpleQueue()
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    log_listener = logging.handlers.QueueListener(log_queue, console_handler)
     logging.basicConfig(
-        level=logging.INFO, 
-        format='%(asctime)s - %(levelname)s - %(message)s'
+        level=logging.INFO,
+        handlers=[logging.handlers.QueueHandler(log_queue)],
+        force=True
     )
+    log_listener.start()
+    atexit.register(log_listener.stop)
     
     print("\n" + "="*60)
     print("SIGHTCEPTION SERVER INITIALIZING")
@@ -172,18 +286,17 @@ if __name__ == "__main__":
 
     # --- Dashboard & API ---
     app = Flask(__name__)
+    Compress(app)
 
     # In-memory activity log (simple ring buffer)
     ACTIVITY_LOG_MAX = 200
-    activity_log = []
+    activity_log = collections.deque(maxlen=ACTIVITY_LOG_MAX)
 
     def push_log(source, message):
         ts = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         entry = {"time": ts, "source": source, "message": message}
         activity_log.append(entry)
-        if len(activity_log) > ACTIVITY_LOG_MAX:
-            del activity_log[:len(activity_log)-ACTIVITY_LOG_MAX]
-        logging.info(f"LOG[{source}]: {message}")
+        logging.info("LOG[%s]: %s", source, message)
 
     # MQTT log callback
     def on_log_message(topic: str, payload: bytes):
@@ -195,107 +308,93 @@ if __name__ == "__main__":
 
     @app.route("/api/capture", methods=["POST"])
     def api_capture():
-        # Subscribe to image stream while capturing
-        mqtt_handler.start_image_polling()
-
-        # Baseline mtime of current image (to detect a fresh one)
-        img_path = os.path.join(os.path.dirname(__file__), "received_images", "current_image.jpg")
-        prev_mtime = os.path.getmtime(img_path) if os.path.exists(img_path) else 0
-
-        # Send a capture request to the ESP32-CAM via a control topic
-        topic = "sightception/camera/command"
-        ok = mqtt_handler.publish_json(topic, {"action": "capture_once", "ts": int(time.time())})
+        ok, arrived = _capture_and_wait(timeout=15.0)
         push_log("server", f"Capture command sent: {ok}")
-
-        # Wait up to 6s for a new image
-        deadline = time.time() + 15.0
-        latest_url = None
-        while time.time() < deadline:
-            if os.path.exists(img_path):
-                try:
-                    m = os.path.getmtime(img_path)
-                    if m > prev_mtime:
-                        latest_url = url_for('serve_image', filename='current_image.jpg')
-                        break
-                except Exception:
-                    pass
-            time.sleep(0.15)
-
-        mqtt_handler.stop_image_polling()
-        return jsonify({"ok": bool(ok), "latest_image_url": latest_url})
+        latest_url = latest_image_info()[0] if arrived else None
+        return json_response({"ok": bool(ok), "latest_image_url": latest_url})
 
     @app.route("/api/detect", methods=["POST"])
     def api_detect():
         logging.info("/api/detect called")
-        # Subscribe to image while capturing
-        mqtt_handler.start_image_polling()
-
-        img_path = os.path.join(os.path.dirname(__file__), "received_images", "current_image.jpg")
-        prev_mtime = os.path.getmtime(img_path) if os.path.exists(img_path) else 0
-
-        # Ask camera to capture
-        topic = "sightception/camera/command"
-        mqtt_handler.publish_json(topic, {"action": "capture_once", "ts": int(time.time())})
+        _, arrived = _capture_and_wait(timeout=6.0)
         push_log("server", "Detect command: capture_once sent")
 
-        # Wait for fresh image
-        deadline = time.time() + 6.0
-        while time.time() < deadline:
-            if os.path.exists(img_path):
-                try:
-                    m = os.path.getmtime(img_path)
-                    if m > prev_mtime:
-                        break
-                except Exception:
-                    pass
-            time.sleep(0.15)
-
-        mqtt_handler.stop_image_polling()
-
         detected = []
-        latest_url = url_for('serve_image', filename='current_image.jpg') if os.path.exists(img_path) else None
+        latest_url = latest_image_info()[0] if arrived else None
         if latest_url:
             logging.info("/api/detect: fresh image detected; running YOLO")
-            detected = yolo_detector.predict(img_path)
+            detected = frame_batcher.predict(mqtt_handler.latest_image_bytes)
             if detected:
-                try:
-                    generate_and_play_audio(current_device_id, detected)
-                except Exception as e:
-                    logging.warning(f"Audio playback failed in detect API: {e}")
+                audio_queue.put((current_device_id, detected))
         else:
             logging.info("/api/detect: no fresh image within timeout")
         push_log("server", f"Detection result: {detected}")
-        return jsonify({"detected": detected, "latest_image_url": latest_url})
+        return json_response({"detected": detected, "latest_image_url": latest_url})
 
     @app.route("/api/status")
     def api_status():
-        img_dir = os.path.join(os.path.dirname(__file__), "received_images")
-        latest_url = None
-        latest_path = os.path.join(img_dir, "current_image.jpg")
-        if os.path.exists(latest_path):
-            latest_url = url_for('serve_image', filename='current_image.jpg')
-        return jsonify({
+        latest_url, latest_mtime = latest_image_info()
+        return json_response({
             "broker": f"{BROKER_HOST}:{BROKER_PORT}",
             "device_id": current_device_id,
             "latest_image_url": latest_url,
-            "activity": activity_log[-ACTIVITY_LOG_MAX:]
+            "latest_image_mtime": latest_mtime,
+            "activity": list(activity_log)
         })
 
     @app.route('/images/<path:filename>')
     def serve_image(filename):
-        directory = os.path.join(os.path.dirname(__file__), 'received_images')
-        # Werkzeug>=3 removed cache_timeout in favor of max_age
+        path = safe_join(IMAGE_DIR, filename)
+        if path is None:
+            abort(404)
         try:
-            return send_from_directory(directory, filename, max_age=0)
-        except TypeError:
-            # Fallback for older Werkzeug
-            return send_from_directory(directory, filename)
+            st = os.stat(path)
+        except OSError:
+            abort(404)
+        if not stat.S_ISREG(st.st_mode):
+            abort(404)
+
+        # Unchanged since the client's copy: answer without touching the file
+        etag = f"{st.st_mtime_ns:x}-{st.st_size:x}"
+        if etag in request.if_none_match:
+            return Response(status=304, headers={"ETag": f'"{etag}"', "Cache-Control": "no-cache"})
+
+        with image_cache_lock:
+            cached = image_cache.get(filename)
+            if cached is None or cached[0] != etag:
+                with open(path, 'rb') as f:
+                    cached = (etag, f.read())
+                image_cache[filename] = cached
+                if len(image_cache) > IMAGE_CACHE_MAX:
+                    image_cache.popitem(last=False)
+            image_cache.move_to_end(filename)
+
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        return send_file(
+            BytesIO(cached[1]),
+            mimetype=mimetype,
+            conditional=True,
+            etag=etag,
+            last_modified=st.st_mtime,
+            max_age=0,
+        )
 
     # Initialize components
     logging.info("Initializing YOLO detector...")
     yolo_detector = YOLODetector()
+    yolo_detector.warmup()
+    frame_batcher = FrameBatcher(yolo_detector, max_batch=yolo_detector.max_batch)
+
+    # Keep the audio device open for the process lifetime
+    logging.info("Initializing audio mixer...")
+    try:
+        pygame.mixer.init()
+        atexit.register(pygame.mixer.quit)
+    except Exception as e:
+        logging.error("Failed to initialize audio mixer: %s", e)
+    threading.Thread(target=audio_worker, daemon=True).start()
     
-    logging.info(f"Connecting to MQTT broker: {BROKER_HOST}:{BROKER_PORT}")
+    logging.info("Connecting to MQTT broker: %s:%s", BROKER_HOST, BROKER_PORT)
     mqtt_handler = SightCeptionMQTTHandler(
         broker_host=BROKER_HOST,
         broker_port=BROKER_PORT,
@@ -319,8 +418,10 @@ if __name__ == "__main__":
     print("="*60)
 
     try:
-        app.run(host="127.0.0.1", port=5000, debug=False)
-    except KeyboardInterrupt:
+        # Single process: YOLO, the mixer and MQTT are process-wide singletons.
+        # waitress handles Ctrl+C itself and returns, so clean up in finally.
+        serve(app, host="127.0.0.1", port=5000, threads=8)
+    finally:
         print("\n" + "="*60)
         print("SERVER SHUTTING DOWN")
         print("="*60)
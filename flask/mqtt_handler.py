@@ -1,13 +1,102 @@
 import paho.mqtt.client as mqtt
 import logging
 import threading
-import json
-import base64
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+import pybase64
 import os
-from datetime import datetime
+import time
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# --- Topics ---
+SIGNAL_TOPIC = "sightception/device/sightception-esp32-001/signal"
+LOGS_TOPIC = "sightception/logs/#"
+IMAGE_TOPIC = "hydroshiba/esp32/cam_image"  # Raw JPEG, one message per frame
+CHUNKED_IMAGE_PREFIX = IMAGE_TOPIC + "/"  # <image_id>/start|chunk/<idx>|end
+
+class ImageWriter:
+    """
+    Writes received frames to disk on a background thread so the MQTT network
+    loop never blocks on file I/O.
+
+    Writes are coalesced per path: if a newer frame for the same file arrives
+    before the previous one was flushed, only the newest is written. Where
+    os.pwrite exists each file is opened once and rewritten in place, so a
+    frame costs a write and a truncate rather than an open/makedirs/close.
+    Elsewhere (Windows) an open handle would block deleting the file, so it
+    is opened and closed per write.
+    """
+    def __init__(self, on_written=None):
+        """
+        Initializes the writer and starts its thread.
+        on_written(path) is called on the writer thread after each successful write.
+        """
+        self.on_written = on_written
+        self._cond = threading.Condition()
+        self._pending = {}  # path -> bytes, newest wins
+        self._fds = {}  # path -> open file descriptor (writer thread only)
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def submit(self, path, data):
+        """
+        Queue data to be written to path, replacing any unwritten data for it.
+        """
+        with self._cond:
+            self._pending[path] = data
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch, self._pending = self._pending, {}
+
+            for path, data in batch.items():
+                try:
+                    self._write(path, data)
+                except Exception as e:
+                    logger.error("Error writing image %s: %s", path, e)
+                    self._close(path)
+                    continue
+                if self.on_written:
+                    try:
+                        self.on_written(path)
+                    except Exception as e:
+                        logger.error("Error in image write callback: %s", e)
+
+    def _write(self, path, data):
+        if not hasattr(os, "pwrite"):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+            return
+
+        fd = self._fds.get(path)
+        if fd is not None and os.fstat(fd).st_nlink == 0:
+            # File was deleted under us (e.g. image folder emptied); recreate it
+            self._close(path)
+            fd = None
+        if fd is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+            self._fds[path] = fd
+
+        os.pwrite(fd, data, 0)
+        os.ftruncate(fd, len(data))
+
+    def _close(self, path):
+        fd = self._fds.pop(path, None)
+        if fd is not None:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
 
 class SightCeptionMQTTHandler:
     """
@@ -20,20 +109,30 @@ class SightCeptionMQTTHandler:
         self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
         self.client.on_connect = self._on_connect
         self.client.on_message = self._on_message
+        # Known topics are routed by paho's topic matcher straight to their
+        # handler; _on_message only sees everything else
+        self.client.message_callback_add(SIGNAL_TOPIC, self._handle_signal_message)
+        self.client.message_callback_add(IMAGE_TOPIC, self._handle_raw_image_data)
+        self.client.message_callback_add(LOGS_TOPIC, self._handle_log_message)
+        # Let bursts of frames/logs flow without stalling on acks; no outgoing queue cap
+        self.client.max_inflight_messages_set(64)
+        self.client.max_queued_messages_set(0)
 
         # Only set credentials if provided
         if username and password:
             self.client.username_pw_set(username, password)
-            logging.info("MQTT authentication configured")
+            logger.info("MQTT authentication configured")
         else:
-            logging.info("MQTT configured without authentication (public broker)")
+            logger.info("MQTT configured without authentication (public broker)")
 
         self.broker_host = broker_host
         self.broker_port = broker_port
         
         self.callbacks = {}
         self.latest_image_path = None
+        self.latest_image_bytes = None  # Newest frame payload, available before it hits disk
         self.image_received = False
+        self.image_arrived_event = threading.Event()  # Set once a fresh image is on disk
         self.image_received_callback = None  # Callback for immediate image processing
         self.signal_callback = None  # Callback for signal messages
         self.log_callback = None  # Callback for generic log messages
@@ -44,63 +143,52 @@ class SightCeptionMQTTHandler:
         self._received_chunks = 0
         self._image_size = 0
         self._buffer = bytearray()
+        # Disk writes for current_image.jpg happen off the network thread
+        self._image_dir = os.path.join(os.path.dirname(__file__), "received_images")
+        os.makedirs(self._image_dir, exist_ok=True)
+        self._image_path = os.path.join(self._image_dir, "current_image.jpg")
+        self.image_writer = ImageWriter(on_written=self._on_image_written)
+        # Signal/log/event callbacks run here, in arrival order, so slow
+        # application code never stalls paho's network loop
+        self._dispatcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mqtt-dispatch")
 
     def _on_connect(self, client, userdata, flags, rc, properties):
         """
         Callback for when the client connects to the broker.
         """
         if rc == 0:
-            logging.info("Successfully connected to MQTT Broker!")
+            logger.info("Successfully connected to MQTT Broker!")
             # Subscribe to the specific signal topic
-            signal_topic = "sightception/device/sightception-esp32-001/signal"
-            self.client.subscribe(signal_topic)
-            logging.info(f"Subscribed to signal topic: {signal_topic}")
+            # QoS 1: a wake-word press must not be lost
+            self.client.subscribe(SIGNAL_TOPIC, qos=1)
+            logger.info("Subscribed to signal topic: %s", SIGNAL_TOPIC)
             # Subscribe to raw image topic (started/stopped explicitly too)
             # Also subscribe to logs by default for dashboard aggregation
-            logs_topic = "sightception/logs/#"
             try:
-                self.client.subscribe(logs_topic)
-                logging.info(f"Subscribed to logs topic: {logs_topic}")
+                self.client.subscribe(LOGS_TOPIC, qos=0)
+                logger.info("Subscribed to logs topic: %s", LOGS_TOPIC)
             except Exception as e:
-                logging.warning(f"Failed to subscribe to logs topic: {e}")
+                logger.warning("Failed to subscribe to logs topic: %s", e)
 
             # Subscribe to chunked image topics (wildcard)
             try:
-                base = "hydroshiba/esp32/cam_image/#"
-                self.client.subscribe(base)
-                logging.info(f"Subscribed to chunked image topics: {base}")
+                base = CHUNKED_IMAGE_PREFIX + "#"
+                self.client.subscribe(base, qos=0)
+                logger.info("Subscribed to chunked image topics: %s", base)
             except Exception as e:
-                logging.warning(f"Failed to subscribe to chunked topics: {e}")
+                logger.warning("Failed to subscribe to chunked topics: %s", e)
         else:
-            logging.error(f"Failed to connect, return code {rc}")
+            logger.error("Failed to connect, return code %s", rc)
 
     def _on_message(self, client, userdata, msg):
         """
-        Callback for when a message is received.
+        Callback for messages not routed by message_callback_add
+        (signal, raw image and log topics are handled there).
         """
-        logging.info(f"Received message on topic {msg.topic}")
+        logger.debug("Received message on topic %s", msg.topic)
         try:
-            # Handle signal messages
-            if msg.topic == "sightception/device/sightception-esp32-001/signal":
-                self._handle_signal_message(msg)
-                return
-            
-            # Handle logs aggregation
-            if msg.topic.startswith("sightception/logs/"):
-                if self.log_callback:
-                    try:
-                        self.log_callback(msg.topic, msg.payload)
-                    except Exception as e:
-                        logging.error(f"Error in log callback: {e}")
-                return
-                
-            # Handle raw image data from ESP32 camera (legacy single message)
-            if msg.topic == "hydroshiba/esp32/cam_image":
-                self._handle_raw_image_data(msg)
-                return
-
             # Handle chunked image protocol
-            if msg.topic.startswith("hydroshiba/esp32/cam_image/"):
+            if msg.topic.startswith(CHUNKED_IMAGE_PREFIX):
                 self._handle_chunked_image(msg)
                 return
                 
@@ -109,8 +197,8 @@ class SightCeptionMQTTHandler:
                 self._handle_image_data(msg)
                 return
                 
-            payload = json.loads(msg.payload.decode())
-            logging.info(f"Payload: {payload}")
+            payload = orjson.loads(msg.payload)
+            logger.debug("Payload: %s", payload)
             
             # Check for a registered callback for this topic
             topic_parts = msg.topic.split('/')
@@ -118,62 +206,68 @@ class SightCeptionMQTTHandler:
                 # e.g., sightception/device/device_id/image_request
                 device_id = topic_parts[2]
                 event_type = topic_parts[3]
-                logging.info(f"Processing {event_type} from device {device_id}")
+                logger.info("Processing %s from device %s", event_type, device_id)
                 
                 if event_type in self.callbacks:
-                    self.callbacks[event_type](device_id, payload)
+                    self._dispatch(f"{event_type} callback", self.callbacks[event_type], device_id, payload)
                 else:
-                    logging.warning(f"No callback registered for event type: {event_type}")
-        except json.JSONDecodeError as e:
-            logging.warning(f"Received non-JSON message on topic {msg.topic}: {msg.payload}")
+                    logger.warning("No callback registered for event type: %s", event_type)
+        except orjson.JSONDecodeError as e:
+            logger.warning("Received non-JSON message on topic %s: %s", msg.topic, msg.payload)
         except Exception as e:
-            logging.error(f"Error processing message on topic {msg.topic}: {e}")
+            logger.error("Error processing message on topic %s: %s", msg.topic, e)
 
-    def _handle_signal_message(self, msg):
+    def _handle_log_message(self, client, userdata, msg):
+        """
+        Forward device/server log messages to the log callback.
+        """
+        if self.log_callback:
+            self._dispatch("log callback", self.log_callback, msg.topic, msg.payload)
+
+    def _handle_signal_message(self, client, userdata, msg):
         """
         Handle wake word signal messages from ESP32.
         """
         try:
-            payload = json.loads(msg.payload.decode())
-            logging.info(f"Signal message received: {payload}")
+            payload = orjson.loads(msg.payload)
+            logger.info("Signal message received: %s", payload)
             
             # Extract device_id from the signal
             device_id = payload.get("device_id", "sightception-esp32-001")
             timestamp = payload.get("timestamp", 0)
             
-            logging.info(f"Wake word signal from device {device_id} at timestamp {timestamp}")
+            logger.info("Wake word signal from device %s at timestamp %s", device_id, timestamp)
             
             # Call the signal callback if registered
             if self.signal_callback:
-                self.signal_callback(device_id, payload)
+                self._dispatch("signal callback", self.signal_callback, device_id, payload)
             else:
-                logging.warning("No signal callback registered")
+                logger.warning("No signal callback registered")
                 
-        except json.JSONDecodeError as e:
-            logging.error(f"Failed to parse signal message JSON: {e}")
+        except orjson.JSONDecodeError as e:
+            logger.error("Failed to parse signal message JSON: %s", e)
         except Exception as e:
-            logging.error(f"Error handling signal message: {e}")
+            logger.error("Error handling signal message: %s", e)
 
     def _handle_image_data(self, msg):
         """
-        Handle incoming image data from ESP32.
+        Handle incoming base64 JSON image data from ESP32.
+        Legacy path: the camera firmware publishes raw JPEG bytes on
+        hydroshiba/esp32/cam_image, which skips encoding entirely.
         """
         try:
-            payload = json.loads(msg.payload.decode())
+            payload = orjson.loads(msg.payload)
             image_data_b64 = payload.get('image_data')
             device_id = msg.topic.split('/')[2]
             
             if image_data_b64:
-                # Decode base64 image data
-                image_data = base64.b64decode(image_data_b64)
+                # Decode base64 image data (SIMD-accelerated; prefer the raw binary topic)
+                image_data = pybase64.b64decode(image_data_b64, validate=False)
                 
-                # Save image with timestamp
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                # Save image with timestamp (ns resolution also keeps same-second frames apart)
+                timestamp = time.time_ns()
                 image_filename = f"received_image_{device_id}_{timestamp}.jpg"
-                image_path = os.path.join(os.path.dirname(__file__), "received_images", image_filename)
-                
-                # Ensure directory exists
-                os.makedirs(os.path.dirname(image_path), exist_ok=True)
+                image_path = os.path.join(self._image_dir, image_filename)
                 
                 # Save image
                 with open(image_path, 'wb') as f:
@@ -181,42 +275,49 @@ class SightCeptionMQTTHandler:
                 
                 self.latest_image_path = image_path
                 self.image_received = True
-                logging.info(f"Image saved: {image_path}")
+                logger.info("Image saved: %s", image_path)
             else:
-                logging.warning("No image data in payload")
+                logger.warning("No image data in payload")
                 
         except Exception as e:
-            logging.error(f"Error handling image data: {e}")
+            logger.error("Error handling image data: %s", e)
 
-    def _handle_raw_image_data(self, msg):
+    def _handle_raw_image_data(self, client, userdata, msg):
         """
         Handle raw image data from ESP32 camera.
         """
         try:
-            # The payload is raw image data
-            image_data = msg.payload
-            
-            # Save image with fixed name (overwrites previous image)
-            image_filename = "current_image.jpg"
-            image_path = os.path.join(os.path.dirname(__file__), "received_images", image_filename)
-            
-            # Ensure directory exists
-            os.makedirs(os.path.dirname(image_path), exist_ok=True)
-            
-            # Save image (overwrites if exists)
-            with open(image_path, 'wb') as f:
-                f.write(image_data)
-            
-            self.latest_image_path = image_path
-            self.image_received = True
-            logging.info(f"Raw image saved: {image_path}")
-            
-            # Trigger immediate detection if callback is set
-            if self.image_received_callback:
-                self.image_received_callback()
+            # The payload is raw image data; save with fixed name (overwrites previous image)
+            # One read-only view of the payload is shared by the writer and detection
+            buf = memoryview(msg.payload)
+            # Publish the bytes before the write so the arrival event never precedes them
+            self.latest_image_bytes = buf
+            self.image_writer.submit(self._image_path, buf)
+            logger.debug("Raw image queued for write: %s", self._image_path)
+            self._on_image_data(buf)
                 
         except Exception as e:
-            logging.error(f"Error handling raw image data: {e}")
+            logger.error("Error handling raw image data: %s", e)
+
+    def _on_image_written(self, image_path):
+        """
+        Called by the image writer once a frame is on disk.
+        """
+        self.latest_image_path = image_path
+        self.image_received = True
+        self.image_arrived_event.set()
+        logger.debug("Image saved: %s", image_path)
+
+    def _on_image_data(self, image_data):
+        """
+        Hand a complete frame to the detection callback without waiting for disk.
+        """
+        # Trigger immediate detection if callback is set
+        if self.image_received_callback:
+            try:
+                self.image_received_callback(image_data)
+            except Exception as e:
+                logger.error("Error in image_received_callback: %s", e)
 
     def _handle_chunked_image(self, msg):
         """Reassemble chunked image sent over MQTT topics:
@@ -233,9 +334,8 @@ class SightCeptionMQTTHandler:
 
             if len(parts) == 5 and parts[4] == 'start':
                 # Initialize assembly
-                payload = msg.payload.decode(errors='ignore')
                 try:
-                    meta = json.loads(payload)
+                    meta = orjson.loads(msg.payload)
                     total = int(meta.get('total', 0))
                     size = int(meta.get('size', 0))
                 except Exception:
@@ -246,7 +346,7 @@ class SightCeptionMQTTHandler:
                 self._image_size = size
                 self._received_chunks = 0
                 self._buffer = bytearray()
-                logging.info(f"Chunked image start: id={image_id} total={total} size={size}")
+                logger.info("Chunked image start: id=%s total=%s size=%s", image_id, total, size)
                 return
 
             if len(parts) == 6 and parts[4] == 'chunk':
@@ -264,21 +364,14 @@ class SightCeptionMQTTHandler:
                 ok_len = (self._image_size == 0) or (len(self._buffer) == self._image_size)
                 ok_cnt = (self._expected_total == 0) or (self._received_chunks == self._expected_total)
                 if ok_len and ok_cnt and len(self._buffer) > 0:
-                    image_filename = "current_image.jpg"
-                    image_path = os.path.join(os.path.dirname(__file__), "received_images", image_filename)
-                    os.makedirs(os.path.dirname(image_path), exist_ok=True)
-                    with open(image_path, 'wb') as f:
-                        f.write(self._buffer)
-                    self.latest_image_path = image_path
-                    self.image_received = True
-                    logging.info(f"Chunked image saved: {image_path} (chunks={self._received_chunks}, bytes={len(self._buffer)})")
-                    if self.image_received_callback:
-                        try:
-                            self.image_received_callback()
-                        except Exception as e:
-                            logging.error(f"Error in image_received_callback: {e}")
+                    # The buffer is replaced below, never mutated, so it can be handed off as-is.
+                    # Publish the bytes before the write so the arrival event never precedes them
+                    self.latest_image_bytes = self._buffer
+                    self.image_writer.submit(self._image_path, self._buffer)
+                    logger.info("Chunked image queued for write: %s (chunks=%s, bytes=%s)", self._image_path, self._received_chunks, len(self._buffer))
+                    self._on_image_data(self._buffer)
                 else:
-                    logging.warning(f"Chunked image incomplete: id={image_id} chunks={self._received_chunks}/{self._expected_total} bytes={len(self._buffer)}/{self._image_size}")
+                    logger.warning("Chunked image incomplete: id=%s chunks=%s/%s bytes=%s/%s", image_id, self._received_chunks, self._expected_total, len(self._buffer), self._image_size)
                 # Reset state
                 self._assembling = False
                 self._current_image_id = None
@@ -288,7 +381,19 @@ class SightCeptionMQTTHandler:
                 self._buffer = bytearray()
                 return
         except Exception as e:
-            logging.error(f"Error handling chunked image: {e}")
+            logger.error("Error handling chunked image: %s", e)
+
+    def _dispatch(self, name, function, *args):
+        """
+        Run an application callback on the dispatch thread, logging any error.
+        """
+        def run():
+            try:
+                function(*args)
+            except Exception as e:
+                logger.error("Error in %s: %s", name, e)
+
+        self._dispatcher.submit(run)
 
     def register_callback(self, event_type, function):
         """
@@ -296,14 +401,14 @@ class SightCeptionMQTTHandler:
         e.g., event_type = "image_request"
         """
         self.callbacks[event_type] = function
-        logging.info(f"Callback registered for event type: {event_type}")
+        logger.info("Callback registered for event type: %s", event_type)
 
     def register_signal_callback(self, function):
         """
         Register a callback function for signal messages.
         """
         self.signal_callback = function
-        logging.info("Signal callback registered")
+        logger.info("Signal callback registered")
 
     def register_log_callback(self, function):
         """
@@ -311,39 +416,39 @@ class SightCeptionMQTTHandler:
         The callback signature should be: func(topic: str, payload: bytes)
         """
         self.log_callback = function
-        logging.info("Log callback registered")
+        logger.info("Log callback registered")
 
     def connect(self):
         """
         Connect to the MQTT broker and start the loop in a background thread.
         """
         try:
-            logging.info(f"Connecting to {self.broker_host}:{self.broker_port}...")
+            logger.info("Connecting to %s:%s...", self.broker_host, self.broker_port)
             self.client.connect(self.broker_host, self.broker_port)
-            # Start the loop in a non-blocking way
-            thread = threading.Thread(target=self.client.loop_forever)
-            thread.daemon = True
-            thread.start()
-            logging.info("MQTT client loop started in background thread")
+            # paho runs (and reconnects) the network loop on its own thread
+            self.client.loop_start()
+            logger.info("MQTT client loop started in background thread")
         except Exception as e:
-            logging.error(f"Could not connect to MQTT broker: {e}")
+            logger.error("Could not connect to MQTT broker: %s", e)
 
-    def publish(self, topic, payload):
+    def publish(self, topic, payload, qos=0, retain=False):
         """
         Publish a message to a specific topic.
+        Dicts/lists are serialized to JSON bytes; str and bytes are sent as-is.
         """
         try:
-            if not isinstance(payload, str):
-                payload = json.dumps(payload)
-            result = self.client.publish(topic, payload)
+            # paho accepts bytes, so orjson output is passed through without re-encoding
+            if isinstance(payload, (dict, list)):
+                payload = orjson.dumps(payload)
+            result = self.client.publish(topic, payload, qos=qos, retain=retain)
             status = result[0]
             if status == 0:
-                logging.info(f"Successfully sent message to topic {topic}")
+                logger.debug("Successfully sent message to topic %s", topic)
             else:
-                logging.warning(f"Failed to send message to topic {topic}")
+                logger.warning("Failed to send message to topic %s", topic)
             return status == 0
         except Exception as e:
-            logging.error(f"Error publishing to topic {topic}: {e}")
+            logger.error("Error publishing to topic %s: %s", topic, e)
             return False
 
     def get_latest_image_path(self):
@@ -361,6 +466,8 @@ class SightCeptionMQTTHandler:
     def set_image_received_callback(self, callback):
         """
         Set callback to be called immediately when image is received.
+        The callback signature should be: func(image_data), where image_data is
+        a bytes-like object (memoryview or bytearray) holding the encoded frame.
         """
         self.image_received_callback = callback
 
@@ -374,22 +481,17 @@ class SightCeptionMQTTHandler:
         """
         Subscribe to image topic to start receiving images.
         """
-        image_topic = "hydroshiba/esp32/cam_image"
-        self.client.subscribe(image_topic)
-        logging.info(f"Started image polling - subscribed to: {image_topic}")
+        # QoS 0: frames are latest-wins, a dropped one is simply replaced
+        self.client.subscribe(IMAGE_TOPIC, qos=0)
+        logger.info("Started image polling - subscribed to: %s", IMAGE_TOPIC)
 
     def stop_image_polling(self):
         """
         Unsubscribe from image topic to stop receiving images.
         """
-        image_topic = "hydroshiba/esp32/cam_image"
-        self.client.unsubscribe(image_topic)
-        logging.info(f"Stopped image polling - unsubscribed from: {image_topic}") 
+        self.client.unsubscribe(IMAGE_TOPIC)
+        logger.info("Stopped image polling - unsubscribed from: %s", IMAGE_TOPIC) 
 
-    def publish_json(self, topic, payload_dict):
-        """Publish a JSON payload (dict) convenience helper."""
-        try:
-            return self.publish(topic, payload_dict)
-        except Exception as e:
-            logging.error(f"publish_json error on {topic}: {e}")
-            return False
\ No newline at end of file
+    def publish_json(self, topic, payload_dict, qos=0, retain=False):
+        """Publish a JSON payload (dict) convenience helper; alias of publish()."""
+        return self.publish(topic, payload_dict, qos=qos, retain=retain)
\ No newline at end of file
@@ -1,8 +1,10 @@
-import time
 from urllib.parse import urljoin
 
+import pandas as pd
 import requests
 import streamlit as st
+from requests.adapters import HTTPAdapter
+from streamlit_autorefresh import st_autorefresh
 
 
 st.set_page_config(page_title="SightCeption Dashboard", page_icon="👓", layout="wide")
@@ -27,10 +29,19 @@ def get_backend_base_url() -> str:
     return base
 
 
+@st.cache_resource
+def get_session() -> requests.Session:
+    # One pooled keep-alive session shared by every rerun
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return session
+
+
 def api_get(path: str, timeout: float = 15.0):
     base = get_backend_base_url()
     try:
-        r = requests.get(urljoin(base, path.lstrip('/')), timeout=timeout)
+        r = get_session().get(urljoin(base, path.lstrip('/')), timeout=timeout)
         r.raise_for_status()
         return r.json()
     except Exception as e:
@@ -41,7 +52,7 @@ def api_get(path: str, timeout: float = 15.0):
 def api_post(path: str, timeout: float = 15.0):
     base = get_backend_base_url()
     try:
-        r = requests.post(urljoin(base, path.lstrip('/')), timeout=timeout)
+        r = get_session().post(urljoin(base, path.lstrip('/')), timeout=timeout)
         r.raise_for_status()
         return r.json()
     except Exception as e:
@@ -49,12 +60,29 @@ def api_post(path: str, timeout: float = 15.0):
         return None
 
 
+@st.cache_data(ttl=1.0, show_spinner=False)
+def _fetch_status(base: str):
+    # base is part of the cache key, so switching backends never serves another's status
+    return api_get("/api/status")
+
+
+def get_status(fresh: bool = False) -> dict:
+    # Widgets in the same rerun share one /api/status call
+    if fresh:
+        _fetch_status.clear()
+    return _fetch_status(get_backend_base_url()) or {}
+
+
 def full_image_url(relative_or_abs: str | None) -> str | None:
+    # Backend URLs are versioned by image mtime, so no cache-buster is needed
     if not relative_or_abs:
         return None
     if relative_or_abs.startswith('http://') or relative_or_abs.startswith('https://'):
-        return f"{relative_or_abs}?t={int(time.time())}"
-    return urljoin(get_backend_base_url(), f"{relative_or_abs.lstrip('/')}?t={int(time.time())}")
+        return relative_or_abs
+    return urljoin(get_backend_base_url(), relative_or_abs.lstrip('/'))
+
+
+ACTIVITY_COLUMNS = ["time", "source", "message"]
 
 
 tab1, tab2, tab3 = st.tabs(["Adjust Camera Angle", "Test Object Detection", "Activity Log"])
@@ -71,9 +99,9 @@ with tab1:
                 st.session_state.preview_url = full_image_url(res.get("latest_image_url"))
                 if not st.session_state.preview_url:
                     # Fallback: status
-                    st.session_state.preview_url = full_image_url(api_get("/api/status").get("latest_image_url"))
+                    st.session_state.preview_url = full_image_url(get_status(fresh=True).get("latest_image_url"))
         if st.button("Refresh Preview"):
-            st.session_state.preview_url = full_image_url(api_get("/api/status").get("latest_image_url"))
+            st.session_state.preview_url = full_image_url(get_status(fresh=True).get("latest_image_url"))
 
     with col_b:
         prev = st.session_state.get("preview_url")
@@ -116,24 +144,17 @@ with tab3:
         auto = st.checkbox("Auto refresh", value=True)
         refresh_ms = st.slider("Interval (ms)", 500, 5000, 1500, 500)
 
-    data = api_get("/api/status") or {}
+    data = get_status()
     activity = data.get("activity", [])
     if activity:
-        # Show newest first
-        activity = list(reversed(activity))
-        st.dataframe(activity, use_container_width=True, hide_index=True)
+        # Show newest first; fixed columns skip schema inference
+        df = pd.DataFrame(activity, columns=ACTIVITY_COLUMNS)
+        st.dataframe(df.iloc[::-1], use_container_width=True, hide_index=True)
     else:
         st.info("No activity yet.")
 
-    # Lightweight JS-driven auto-refresh (no extra deps)
+    # Rerun the script on a timer instead of reloading the whole page
     if auto:
-        st.markdown(
-            f"""
-            <script>
-                setTimeout(function() {{ window.location.reload(); }}, {int(refresh_ms)});
-            </script>
-            """,
-            unsafe_allow_html=True,
-        )
+        st_autorefresh(interval=int(refresh_ms), key="logrefresh")
 
 